@@ -1,30 +1,202 @@
 """
 Implementación de agentes base usando Langroid Framework
 """
+import asyncio
+import hashlib
+import importlib
 import logging
-from typing import Dict, Any, List, Optional
+import threading
+from collections import Counter, deque
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 import re
 
+import numpy as np
+import orjson
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
 import langroid as lr
 from langroid import ChatAgent, ChatAgentConfig
 from langroid import Task
-from langroid.language_models import OpenAIGPTConfig
+from langroid.language_models import OpenAIGPTConfig, LanguageModel, LLMMessage, Role
 from langroid.utils.types import *
 from langroid.agent.tools import AgentDoneTool, PassTool, ForwardTool
 
 from app.agents.config import langroid_config
 from app.services.qdrant import QdrantService
+from app.services import shared_cache
 from app.database import get_sync_connection
 from app.controllers.usuario.UsuarioController import UsuarioController
+from app.controllers.mensaje.MensajeController import MensajeController
+from app.services.embedding import EmbeddingService
 
 logger = logging.getLogger(__name__)
 logging.getLogger("langroid").setLevel(logging.ERROR)
 
+# Los scores pueden llegar como escalares numpy
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+_qdrant_service: Optional[QdrantService] = None
+_embedding_service: Optional[EmbeddingService] = None
+_services_lock = threading.Lock()
+
+def _qdrant() -> QdrantService:
+    """Servicio Qdrant compartido por todas las herramientas"""
+    global _qdrant_service
+    if _qdrant_service is None:
+        with _services_lock:
+            if _qdrant_service is None:
+                _qdrant_service = QdrantService()
+    return _qdrant_service
+
+def _embedder() -> EmbeddingService:
+    """Modelo de embeddings compartido; se carga una sola vez por proceso"""
+    global _embedding_service
+    if _embedding_service is None:
+        with _services_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
+    return _embedding_service
+
+@lru_cache(maxsize=1)
+def _chat_controller():
+    """
+    ChatController importado una sola vez; no se importa al inicio del módulo
+    porque ChatController -> langroid_service -> base_agents es circular
+    """
+    return importlib.import_module("app.controllers.chat.ChatController").ChatController
+
+
+class _ProductQueryCache:
+    """
+    Caché de dos niveles para ProductSearchTool:
+    L1 exacto por (query, category, max_results), local y compartido vía Redis,
+    y L2 semántico por similitud coseno contra los embeddings de consultas recientes.
+    """
+    
+    def __init__(self, maxsize: int = 1024, ttl: int = 300,
+                 recent_size: int = 256, threshold: float = 0.97):
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._ttl = ttl
+        self._recent = deque(maxlen=recent_size)
+        self._threshold = threshold
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(query: str, category: Optional[str], max_results: int) -> str:
+        raw = f"{query}\x1f{category or ''}\x1f{max_results}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        result = self.get_local(key)
+        if result is not None:
+            return result
+        return self.get_shared(key)
+    
+    def get_local(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._results.get(key)
+    
+    def get_shared(self, key: str) -> Optional[str]:
+        """Resultado calculado por otro worker (bloqueante: consulta Redis)"""
+        shared = shared_cache.get(f"prod:{key}")
+        if shared is None:
+            return None
+        result = shared.decode("utf-8")
+        with self._lock:
+            self._results[key] = result
+        return result
+    
+    def get_similar(self, key: str, embedding: np.ndarray, category: Optional[str],
+                    max_results: int) -> Optional[str]:
+        """
+        Busca una consulta reciente equivalente semánticamente; si la encuentra,
+        guarda el resultado también bajo la clave exacta para no re-codificar
+        """
+        with self._lock:
+            for cached_embedding, cached_category, cached_max, cached_key in self._recent:
+                if cached_category != category or cached_max != max_results:
+                    continue
+                if float(np.dot(embedding, cached_embedding)) >= self._threshold:
+                    result = self._results.get(cached_key)
+                    if result is not None:
+                        self._results[key] = result
+                        return result
+        return None
+    
+    def put(self, key: str, embedding: np.ndarray, category: Optional[str],
+            max_results: int, result: str):
+        with self._lock:
+            self._results[key] = result
+            self._recent.append((embedding, category, max_results, key))
+    
+    def share(self, key: str):
+        """Publica en Redis el resultado local de la clave, si existe (bloqueante)"""
+        result = self.get_local(key)
+        if result is not None:
+            shared_cache.set(f"prod:{key}", result.encode("utf-8"), self._ttl)
+
+
+_product_cache = _ProductQueryCache()
+
+
+# Intenciones de un solo grupo; toleran tildes y mayúsculas sin copiar el mensaje
+PROMO_RE = re.compile(r"promoci[oó]n|descuento|oferta|rebaja", re.IGNORECASE)
+UNIFORM_RE = re.compile(r"uniforme", re.IGNORECASE)
+BELT_RE = re.compile(r"cintur[oó]n", re.IGNORECASE)
+PROTECT_RE = re.compile(r"protecci[oó]n", re.IGNORECASE)
+
+# Posibles números de teléfono, en orden de prioridad
+PHONE_PATTERNS = [
+    re.compile(r'\+?57\s*3\d{9}'),  # +57 3xxxxxxxxx
+    re.compile(r'3\d{9}'),          # 3xxxxxxxxx
+    re.compile(r'\d{10}')           # 10 digits
+]
+
+# Palabras clave agrupadas por intención; se evalúan con un único regex
+_KEYWORD_BUCKETS = {
+    "purchase": ["comprar", "compra", "precio", "cuanto cuesta", "quiero", "necesito"],
+    "positive": ["gracias", "perfecto", "excelente", "me gusta"],
+    "conversion": ["comprar", "precio", "disponible"],
+}
+
+_KEYWORD_TAGS: Dict[str, set] = {}
+for _tag, _keywords in _KEYWORD_BUCKETS.items():
+    for _keyword in _keywords:
+        _KEYWORD_TAGS.setdefault(_keyword, set()).add(_tag)
+
+_KEYWORD_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_KEYWORD_TAGS, key=len, reverse=True))
+)
+
+
+def _match_keywords(text: str) -> set:
+    """Retorna las intenciones cuyas palabras clave aparecen en el texto"""
+    return {tag for match in _KEYWORD_RE.finditer(text.lower()) for tag in _KEYWORD_TAGS[match.group()]}
+
+
+def _normalize(vector: List[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
+
 # ============================
 # HERRAMIENTAS PERSONALIZADAS
 # ============================
 
+# Campos del payload que consume cada herramienta
+PRODUCT_PAYLOAD_FIELDS = [
+    "nombre", "descripcion", "precio", "categoria", "disponible", "promociones_activas"
+]
+PROMOTION_FILTERS = {"tipo": "promocion", "activa": True}
+PROMOTION_PAYLOAD_FIELDS = [
+    "descripcion", "descuento", "fecha_fin", "total_productos",
+    "metadata", "productos_nombres", "productos_detalles"
+]
+
+EMBEDDING_ERROR_MESSAGE = "Error ejecutando búsqueda: no se pudo procesar la consulta."
+
 class ProductSearchTool(lr.ToolMessage):
     """Herramienta para búsqueda de productos"""
     request: str = "product_search"
@@ -36,51 +208,114 @@ class ProductSearchTool(lr.ToolMessage):
     def handle(self) -> str:
         """Ejecuta búsqueda de productos en Qdrant"""
         try:
-            qdrant_service = QdrantService()
-            
-            from app.services.embedding import EmbeddingService
-            embedding_service = EmbeddingService()
-            query_embedding = embedding_service.encode_query(self.query)
+            cache_key, cached = self._lookup()
+            if cached is not None:
+                return cached
             
-            # Aplicar filtros si se especifica categoría
-            filters = {}
-            if self.category:
-                filters["categoria"] = self.category
+            query_embedding = _embedder().encode_query_batched(self.query)
+            normalized_embedding, cached = self._lookup_similar(cache_key, query_embedding)
+            if cached is not None:
+                return cached
             
             # Buscar documentos similares
-            results = qdrant_service.search_similar(
-                query_embedding, 
-                limit=self.max_results,
-                filters=filters
-            )
+            results = _qdrant().batched_search(query_embedding, **self._search_kwargs())
+            response = self._format_results(results, cache_key, normalized_embedding)
+            _product_cache.share(cache_key)
+            return response
             
-            if not results:
-                return "No se encontraron productos que coincidan con tu búsqueda."
+        except Exception as e:
+            logger.error(f"Error in ProductSearchTool: {str(e)}")
+            return f"Error ejecutando búsqueda: {str(e)}"
+    
+    async def handle_async(self) -> str:
+        """Versión asíncrona: espera el lote de Qdrant sin bloquear el event loop"""
+        try:
+            cache_key = self._cache_key()
+            cached = _product_cache.get_local(cache_key)
+            if cached is None:
+                # Redis es síncrono; no bloquear el event loop
+                cached = await asyncio.to_thread(_product_cache.get_shared, cache_key)
+            if cached is not None:
+                return cached
+            
+            # El encoder es CPU-bound y su primera carga es lenta: ambos ocurren en un hilo
+            query_embedding = await asyncio.to_thread(
+                lambda: _embedder().encode_query_batched(self.query)
+            )
+            normalized_embedding, cached = self._lookup_similar(cache_key, query_embedding)
+            if cached is not None:
+                return cached
             
-            formatted_results = []
-            for result in results:
-                payload = result.get("payload", {})
-                score = result.get("score", 0)
-                
-                disponible_final = payload.get("disponible", False)
-                
-                logger.debug(f"Product {payload.get('nombre', 'N/A')}: disponible={disponible_final}")
-                
-                formatted_results.append({
-                    "nombre": payload.get("nombre", "N/A"),
-                    "descripcion": payload.get("descripcion", "N/A"),
-                    "precio": payload.get("precio", "N/A"),
-                    "categoria": payload.get("categoria", "N/A"),
-                    "disponible": disponible_final,  # Usar valor directo del payload
-                    "promociones_activas": payload.get("promociones_activas", ""),
-                    "relevance_score": score
-                })
-            
-            return str(formatted_results)
+            results = await _qdrant().batched_search_async(query_embedding, **self._search_kwargs())
+            response = self._format_results(results, cache_key, normalized_embedding)
+            await asyncio.to_thread(_product_cache.share, cache_key)
+            return response
             
         except Exception as e:
             logger.error(f"Error in ProductSearchTool: {str(e)}")
             return f"Error ejecutando búsqueda: {str(e)}"
+    
+    def _cache_key(self) -> str:
+        return _product_cache.make_key(self.query, self.category, self.max_results)
+    
+    def _lookup(self) -> Tuple[str, Optional[str]]:
+        """Clave de caché y resultado exacto, si existe (local o compartido)"""
+        cache_key = self._cache_key()
+        return cache_key, _product_cache.get(cache_key)
+    
+    def _lookup_similar(self, cache_key: str,
+                        query_embedding: List[float]) -> Tuple[np.ndarray, Optional[str]]:
+        """Normaliza el embedding y retorna una respuesta anticipada si no hace falta buscar"""
+        normalized_embedding = _normalize(query_embedding)
+        if not normalized_embedding.any():
+            # El encoder falló y devolvió un vector cero; no buscar ni cachear
+            return normalized_embedding, EMBEDDING_ERROR_MESSAGE
+        
+        cached = _product_cache.get_similar(cache_key, normalized_embedding, self.category, self.max_results)
+        return normalized_embedding, cached
+    
+    def _search_kwargs(self) -> Dict[str, Any]:
+        return {
+            "limit": self.max_results,
+            "filters": self._filters(),
+            "payload_fields": PRODUCT_PAYLOAD_FIELDS
+        }
+    
+    def _filters(self) -> Dict[str, Any]:
+        """Aplicar filtros si se especifica categoría"""
+        filters = {}
+        if self.category:
+            filters["categoria"] = self.category
+        return filters
+    
+    def _format_results(self, results: List[Dict[str, Any]], cache_key: str,
+                        normalized_embedding: np.ndarray) -> str:
+        """Serializa los resultados y los guarda en caché"""
+        if not results:
+            return "No se encontraron productos que coincidan con tu búsqueda."
+        
+        formatted_results = []
+        for result in results:
+            payload = result.get("payload", {})
+            score = result.get("score", 0)
+            
+            disponible_final = payload.get("disponible", False)
+            
+            logger.debug(f"Product {payload.get('nombre', 'N/A')}: disponible={disponible_final}")
+            
+            formatted_results.append({
+                "nombre": payload.get("nombre", "N/A"),
+                "descripcion": payload.get("descripcion", "N/A"),
+                "precio": payload.get("precio", "N/A"),
+                "categoria": payload.get("categoria", "N/A"),
+                "disponible": disponible_final,  # Usar valor directo del payload
+                "promociones_activas": payload.get("promociones_activas", ""),
+                "relevance_score": score
+            })
+        
+        response = orjson.dumps(formatted_results, option=_ORJSON_OPTIONS).decode()
+        _product_cache.put(cache_key, normalized_embedding, self.category, self.max_results, response)
+        return response
 
 
 class PromotionSearchTool(lr.ToolMessage):
@@ -91,72 +326,80 @@ class PromotionSearchTool(lr.ToolMessage):
     def handle(self) -> str:
         """Busca promociones activas"""
         try:
-            qdrant_service = QdrantService()
-            
-            from app.services.embedding import EmbeddingService
-            embedding_service = EmbeddingService()
-            
-            # Generar embedding para consulta de promociones
-            promotion_query = "promociones descuentos ofertas especiales productos en oferta"
-            query_embedding = embedding_service.encode_query(promotion_query)
-            
-            filters = {"tipo": "promocion", "activa": True}
-            results = qdrant_service.search_similar(
-                query_embedding,  # Usar embedding real en lugar de vector cero
+            # Las promociones se seleccionan solo por payload; no hace falta búsqueda vectorial
+            results = _qdrant().scroll_by_filter(
+                PROMOTION_FILTERS,
                 limit=10,
-                filters=filters
+                payload_fields=PROMOTION_PAYLOAD_FIELDS
             )
+            return self._format_promotions(results)
             
-            if not results:
-                return "No hay promociones activas en este momento."
-            
-            promotions_info = []
-            for result in results:
-                payload = result.get("payload", {})
-                
-                # Extraer información completa de la promoción
-                promocion_info = {
-                    "descripcion": payload.get("descripcion", "Promoción sin descripción"),
-                    "descuento": payload.get("descuento", 0),
-                    "fecha_fin": payload.get("fecha_fin", "Fecha no especificada"),
-                    "total_productos": payload.get("total_productos", 0)
-                }
-                
-                # Extraer información detallada de productos desde metadata
-                metadata = payload.get("metadata", {})
-                productos_nombres = metadata.get("productos_nombres", "") or payload.get("productos_nombres", "")
-                productos_detalles = metadata.get("productos_detalles", "") or payload.get("productos_detalles", "")
-                
-                if productos_nombres and productos_nombres.strip():
-                    promocion_info["productos_incluidos"] = productos_nombres
-                else:
-                    promocion_info["productos_incluidos"] = "No se especifican productos"
-                
-                if productos_detalles and productos_detalles.strip():
-                    promocion_info["productos_con_precios"] = productos_detalles
-                else:
-                    promocion_info["productos_con_precios"] = "Precios no disponibles"
-                
-                promotions_info.append(promocion_info)
-            
-            # Formatear respuesta de manera legible
-            formatted_response = "🎉 PROMOCIONES ACTIVAS:\n\n"
-            for i, promo in enumerate(promotions_info, 1):
-                formatted_response += f"📍 PROMOCIÓN {i}:\n"
-                formatted_response += f"   • Descripción: {promo['descripcion']}\n"
-                formatted_response += f"   • Descuento: {promo['descuento']}%\n"
-                formatted_response += f"   • Válida hasta: {promo['fecha_fin']}\n"
-                formatted_response += f"   • Total productos: {promo['total_productos']}\n"
-                formatted_response += f"   • Productos incluidos: {promo['productos_incluidos']}\n"
-                if promo['productos_con_precios'] != "Precios no disponibles":
-                    formatted_response += f"   • Detalles con precios: {promo['productos_con_precios']}\n"
-                formatted_response += "\n"
-            
-            return formatted_response
+        except Exception as e:
+            logger.error(f"Error in PromotionSearchTool: {str(e)}")
+            return f"Error obteniendo promociones: {str(e)}"
+    
+    async def handle_async(self) -> str:
+        """Versión asíncrona: consulta Qdrant con el cliente async"""
+        try:
+            results = await _qdrant().scroll_by_filter_async(
+                PROMOTION_FILTERS,
+                limit=10,
+                payload_fields=PROMOTION_PAYLOAD_FIELDS
+            )
+            return self._format_promotions(results)
             
         except Exception as e:
             logger.error(f"Error in PromotionSearchTool: {str(e)}")
             return f"Error obteniendo promociones: {str(e)}"
+    
+    @staticmethod
+    def _format_promotions(results: List[Dict[str, Any]]) -> str:
+        """Formatea las promociones de manera legible"""
+        if not results:
+            return "No hay promociones activas en este momento."
+        
+        promotions_info = []
+        for result in results:
+            payload = result.get("payload", {})
+            
+            # Extraer información completa de la promoción
+            promocion_info = {
+                "descripcion": payload.get("descripcion", "Promoción sin descripción"),
+                "descuento": payload.get("descuento", 0),
+                "fecha_fin": payload.get("fecha_fin", "Fecha no especificada"),
+                "total_productos": payload.get("total_productos", 0)
+            }
+            
+            # Extraer información detallada de productos desde metadata
+            metadata = payload.get("metadata", {})
+            productos_nombres = metadata.get("productos_nombres", "") or payload.get("productos_nombres", "")
+            productos_detalles = metadata.get("productos_detalles", "") or payload.get("productos_detalles", "")
+            
+            if productos_nombres and productos_nombres.strip():
+                promocion_info["productos_incluidos"] = productos_nombres
+            else:
+                promocion_info["productos_incluidos"] = "No se especifican productos"
+            
+            if productos_detalles and productos_detalles.strip():
+                promocion_info["productos_con_precios"] = productos_detalles
+            else:
+                promocion_info["productos_con_precios"] = "Precios no disponibles"
+            
+            promotions_info.append(promocion_info)
+        
+        formatted_response = "🎉 PROMOCIONES ACTIVAS:\n\n"
+        for i, promo in enumerate(promotions_info, 1):
+            formatted_response += f"📍 PROMOCIÓN {i}:\n"
+            formatted_response += f"   • Descripción: {promo['descripcion']}\n"
+            formatted_response += f"   • Descuento: {promo['descuento']}%\n"
+            formatted_response += f"   • Válida hasta: {promo['fecha_fin']}\n"
+            formatted_response += f"   • Total productos: {promo['total_productos']}\n"
+            formatted_response += f"   • Productos incluidos: {promo['productos_incluidos']}\n"
+            if promo['productos_con_precios'] != "Precios no disponibles":
+                formatted_response += f"   • Detalles con precios: {promo['productos_con_precios']}\n"
+            formatted_response += "\n"
+        
+        return formatted_response
 
 
 class UserHistoryTool(lr.ToolMessage):
@@ -169,37 +412,45 @@ class UserHistoryTool(lr.ToolMessage):
     def handle(self) -> str:
         """Obtiene historial reciente del usuario"""
         try:
-            from app.controllers.chat.ChatController import ChatController
-            from app.controllers.mensaje.MensajeController import MensajeController
-            
-            # Obtener chats del usuario
-            chat_controller = ChatController()
-            user_chats = chat_controller.get_chats_by_usuario(self.user_id)
-            
-            if not user_chats:
-                return "Usuario sin historial previo"
-            
-            # Obtener mensajes recientes del chat más reciente
-            latest_chat = user_chats[0]  # Asumiendo orden cronológico
-            mensaje_controller = MensajeController()
-            recent_messages = mensaje_controller.get_mensajes_by_chat(
-                latest_chat.id, self.limit, 0
-            )
-            
-            # Formatear historial
-            history = []
-            for msg in recent_messages:
-                history.append({
-                    "rol": msg.rol,
-                    "contenido": msg.contenido[:200],  # Truncar para contexto
-                    "fecha": msg.fechaCreacion.isoformat() if msg.fechaCreacion else None
-                })
-            
-            return str(history)
-            
+            return _fetch_history(self.user_id, self.limit)
         except Exception as e:
             logger.error(f"Error in UserHistoryTool: {str(e)}")
             return f"Error obteniendo historial: {str(e)}"
+    
+    async def handle_async(self) -> str:
+        """Versión asíncrona: consulta la BD en un hilo sin bloquear el event loop"""
+        try:
+            return await asyncio.to_thread(_fetch_history, self.user_id, self.limit)
+        except Exception as e:
+            logger.error(f"Error in UserHistoryTool: {str(e)}")
+            return f"Error obteniendo historial: {str(e)}"
+
+
+@ttl_cache(maxsize=1024, ttl=30)
+def _fetch_history(user_id: int, limit: int) -> str:
+    """Historial formateado del usuario; se cachea ya serializado por 30 s"""
+    # Obtener chats del usuario (métodos estáticos, sin instanciar controladores)
+    user_chats = _chat_controller().get_chats_by_usuario(user_id)
+    
+    if not user_chats:
+        return "Usuario sin historial previo"
+    
+    # Obtener mensajes recientes del chat más reciente
+    latest_chat = user_chats[0]  # Asumiendo orden cronológico
+    recent_messages = MensajeController.get_mensajes_by_chat(
+        latest_chat.id, limit, 0
+    )
+    
+    # Formatear historial
+    history = []
+    for msg in recent_messages:
+        history.append({
+            "rol": msg.rol,
+            "contenido": msg.contenido[:200],  # Truncar para contexto
+            "fecha": msg.fechaCreacion.isoformat() if msg.fechaCreacion else None
+        })
+    
+    return orjson.dumps(history, option=_ORJSON_OPTIONS).decode()
 
 class PhoneValidationTool(lr.ToolMessage):
     """Herramienta para validar números de teléfono colombianos"""
@@ -294,6 +545,38 @@ class CheckUserPhoneTool(lr.ToolMessage):
 # AGENTES PRINCIPALES
 # ============================
 
+# Plantilla del prompt de contexto para la síntesis final
+CONTEXT_PROMPT_TMPL = """
+            Consulta del usuario: {message}
+            
+            Información de productos encontrada:
+            {knowledge}
+            
+            Recomendaciones de ventas:
+            {sales}
+            
+            Estado actual del teléfono del usuario: {phone_status}
+            
+            INSTRUCCIONES CRÍTICAS PARA DISPONIBILIDAD:
+            - La información de productos viene en formato JSON e incluye el campo "disponible" que indica la disponibilidad
+            - Si "disponible" es true, el producto ESTÁ DISPONIBLE para compra
+            - Si "disponible" es false, el producto NO ESTÁ DISPONIBLE para compra
+            - Responde con precisión sobre la disponibilidad basándote en este campo booleano
+            - NO asumas que no hay disponibilidad si no tienes información clara
+            - La cantidad exacta de unidades no es relevante para el cliente
+            
+            INSTRUCCIONES CRÍTICAS PARA SOLICITAR TELÉFONO:
+            - Si el estado actual del teléfono es "USER_HAS_PHONE_REGISTERED", NUNCA solicites el número de teléfono
+            - Si el estado actual del teléfono es "USER_NO_PHONE_REGISTERED" Y detectas intención de compra, entonces SÍ solicita el número de teléfono
+            - Si detectas "PURCHASE_INTENT_DETECTED" en las recomendaciones de ventas pero el estado es "USER_HAS_PHONE_REGISTERED", NO solicites el teléfono
+            - Si detectas "PURCHASE_INTENT_DETECTED_WITH_PHONE" en las recomendaciones de ventas, NO solicites el teléfono
+            - SIEMPRE verifica el estado actual del teléfono antes de decidir si solicitarlo o no
+            
+            Basándote en esta información, proporciona una respuesta completa y útil al usuario.
+            Mantén el tono amigable y comercial de BaekhoBot 🥋.
+            """
+
+
 class KnowledgeAgent(ChatAgent):
     """Agente especializado en búsqueda de conocimiento"""
     
@@ -306,19 +589,25 @@ class KnowledgeAgent(ChatAgent):
     def handle_message_fallback(self, msg: str) -> str:
         """Maneja consultas de conocimiento"""
         try:
-            # Determinar tipo de consulta
-            if "promocion" in msg.lower() or "descuento" in msg.lower() or "oferta" in msg.lower():
-                # Buscar promociones
-                promotion_tool = PromotionSearchTool()
-                return promotion_tool.handle()
-            else:
-                # Búsqueda general de productos
-                search_tool = ProductSearchTool(query=msg)
-                return search_tool.handle()
-                
+            return self._select_tool(msg).handle()
         except Exception as e:
             logger.error(f"Error in KnowledgeAgent: {str(e)}")
             return "Lo siento, hubo un error accediendo a la base de conocimiento."
+    
+    async def handle_message_fallback_async(self, msg: str) -> str:
+        """Versión asíncrona de handle_message_fallback"""
+        try:
+            return await self._select_tool(msg).handle_async()
+        except Exception as e:
+            logger.error(f"Error in KnowledgeAgent: {str(e)}")
+            return "Lo siento, hubo un error accediendo a la base de conocimiento."
+    
+    @staticmethod
+    def _select_tool(msg: str) -> lr.ToolMessage:
+        """Determinar tipo de consulta: promociones o búsqueda general de productos"""
+        if PROMO_RE.search(msg):
+            return PromotionSearchTool()
+        return ProductSearchTool(query=msg)
 
 
 class SalesAgent(ChatAgent):
@@ -335,14 +624,8 @@ class SalesAgent(ChatAgent):
     def handle_message_fallback(self, msg: str, user_id: Optional[int] = None) -> str:
         """Maneja lógica de ventas"""
         try:
-            phone_patterns = [
-                r'\+?57\s*3\d{9}',  # +57 3xxxxxxxxx
-                r'3\d{9}',          # 3xxxxxxxxx
-                r'\d{10}'           # 10 digits
-            ]
-            
-            for pattern in phone_patterns:
-                matches = re.findall(pattern, msg)
+            for pattern in PHONE_PATTERNS:
+                matches = pattern.findall(msg)
                 if matches:
                     # Found potential phone number, validate it
                     potential_phone = matches[0]
@@ -358,15 +641,14 @@ class SalesAgent(ChatAgent):
             recommendations = []
             
             # Keywords para productos complementarios
-            if "uniforme" in msg.lower():
+            if UNIFORM_RE.search(msg):
                 recommendations.append("¿Has considerado también un cinturón o protecciones?")
-            elif "cinturon" in msg.lower():
+            elif BELT_RE.search(msg):
                 recommendations.append("¿Te interesaría ver nuestros uniformes a juego?")
-            elif "proteccion" in msg.lower():
+            elif PROTECT_RE.search(msg):
                 recommendations.append("¿Necesitas también guantes o espinilleras?")
             
-            purchase_keywords = ["comprar", "compra", "precio", "cuanto cuesta", "quiero", "necesito"]
-            if any(keyword in msg.lower() for keyword in purchase_keywords):
+            if "purchase" in _match_keywords(msg):
                 if user_id:
                     check_phone_tool = CheckUserPhoneTool(user_id=user_id)
                     phone_check_result = check_phone_tool.handle()
@@ -396,26 +678,29 @@ class AnalyticsAgent(ChatAgent):
         super().__init__(config)
         self.conversation_metrics = {
             "total_messages": 0,
-            "user_satisfaction": [],
-            "conversion_indicators": []
+            "user_satisfaction": Counter(),
+            "conversion_indicators": deque(maxlen=1000)  # Solo los más recientes
         }
         
     def track_conversation(self, user_msg: str, bot_response: str):
         """Rastrea métricas de conversación"""
         self.conversation_metrics["total_messages"] += 1
         
-        # Detectar indicadores de satisfacción
-        positive_indicators = ["gracias", "perfecto", "excelente", "me gusta"]
-        if any(indicator in user_msg.lower() for indicator in positive_indicators):
-            self.conversation_metrics["user_satisfaction"].append("positive")
+        # Detectar indicadores de satisfacción y conversión en una sola pasada
+        keyword_tags = _match_keywords(user_msg)
+        if "positive" in keyword_tags:
+            self.conversation_metrics["user_satisfaction"]["positive"] += 1
             
-        conversion_indicators = ["comprar", "precio", "disponible"]
-        if any(indicator in user_msg.lower() for indicator in conversion_indicators):
+        if "conversion" in keyword_tags:
             self.conversation_metrics["conversion_indicators"].append(user_msg[:50])
     
     def get_metrics(self) -> Dict[str, Any]:
         """Obtiene métricas actuales"""
-        return self.conversation_metrics.copy()
+        return {
+            "total_messages": self.conversation_metrics["total_messages"],
+            "user_satisfaction": dict(self.conversation_metrics["user_satisfaction"]),
+            "conversion_indicators": list(self.conversation_metrics["conversion_indicators"])
+        }
 
 
 class MainBaekhoAgent(ChatAgent):
@@ -449,6 +734,9 @@ class MainBaekhoAgent(ChatAgent):
             )
         )
         
+        # Modelo ligero para la síntesis final
+        self._fast_llm = LanguageModel.create(langroid_config.LLM_CONFIG_FAST)
+        
         # Herramientas habilitadas
         self.enable_message(PhoneValidationTool)
         self.enable_message(SavePhoneTool)
@@ -464,7 +752,7 @@ class MainBaekhoAgent(ChatAgent):
                 # Retornar estadísticas por defecto si no hay analytics agent
                 return {
                     "total_messages": 0,
-                    "user_satisfaction": [],
+                    "user_satisfaction": {},
                     "conversion_indicators": [],
                     "status": "analytics_agent_not_available"
                 }
@@ -472,11 +760,22 @@ class MainBaekhoAgent(ChatAgent):
             logger.error(f"Error getting conversation stats: {str(e)}")
             return {
                 "total_messages": 0,
-                "user_satisfaction": [],
+                "user_satisfaction": {},
                 "conversion_indicators": [],
                 "error": str(e)
             }
 
+    async def _knowledge_with_timeout(self, message: str) -> str:
+        """Consulta el Knowledge Agent con latencia acotada; si se excede, continúa sin contexto"""
+        try:
+            return await asyncio.wait_for(
+                self.knowledge_agent.handle_message_fallback_async(message),
+                timeout=langroid_config.SYSTEM_CONFIG["subagent_timeout"]
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Knowledge Agent excedió el tiempo límite")
+            return "Información de productos no disponible en este momento."
+
     async def handle_user_message(self, message: str, user_id: Optional[int] = None, 
                                   conversation_context: Optional[Dict] = None) -> str:
         """Maneja mensaje de usuario orquestando múltiples agentes"""
@@ -484,7 +783,19 @@ class MainBaekhoAgent(ChatAgent):
             # Rastrear con Analytics Agent
             self.analytics_agent.track_conversation(message, "")
             
-            sales_response = self.sales_agent.handle_message_fallback(message, user_id)
+            # Los mensajes con teléfono se resuelven solo con el Sales Agent
+            if any(pattern.search(message) for pattern in PHONE_PATTERNS):
+                sales_response = await asyncio.to_thread(
+                    self.sales_agent.handle_message_fallback, message, user_id
+                )
+                knowledge_response = ""
+            else:
+                # Consultar Sales (BD, en hilo) y Knowledge Agent (Qdrant async) en paralelo
+                logger.info("Consultando Sales y Knowledge Agent...")
+                sales_response, knowledge_response = await asyncio.gather(
+                    asyncio.to_thread(self.sales_agent.handle_message_fallback, message, user_id),
+                    self._knowledge_with_timeout(message),
+                )
             
             # Handle phone number detection and validation
             if "PHONE_DETECTED:" in sales_response:
@@ -514,10 +825,6 @@ class MainBaekhoAgent(ChatAgent):
                 
                 return response
             
-            # 1. Consultar Knowledge Agent para obtener contexto
-            logger.info("Consultando Knowledge Agent...")
-            knowledge_response = self.knowledge_agent.handle_message_fallback(message)
-            
             phone_status_for_context = ""
             if user_id:
                 check_phone_tool = CheckUserPhoneTool(user_id=user_id)
@@ -528,40 +835,24 @@ class MainBaekhoAgent(ChatAgent):
                 else:
                     phone_status_for_context = "USER_NO_PHONE_REGISTERED"
             
-            # 2. Generate final response combining information
-            context_prompt = f"""
-            Consulta del usuario: {message}
-            
-            Información de productos encontrada:
-            {knowledge_response}
-            
-            Recomendaciones de ventas:
-            {sales_response}
-            
-            Estado actual del teléfono del usuario: {phone_status_for_context}
-            
-            INSTRUCCIONES CRÍTICAS PARA DISPONIBILIDAD:
-            - La información de productos incluye el campo 'disponible' que indica la disponibilidad
-            - Si 'disponible' es True, el producto ESTÁ DISPONIBLE para compra
-            - Si 'disponible' es False, el producto NO ESTÁ DISPONIBLE para compra
-            - Responde con precisión sobre la disponibilidad basándote en este campo booleano
-            - NO asumas que no hay disponibilidad si no tienes información clara
-            - La cantidad exacta de unidades no es relevante para el cliente
-            
-            INSTRUCCIONES CRÍTICAS PARA SOLICITAR TELÉFONO:
-            - Si el estado actual del teléfono es "USER_HAS_PHONE_REGISTERED", NUNCA solicites el número de teléfono
-            - Si el estado actual del teléfono es "USER_NO_PHONE_REGISTERED" Y detectas intención de compra, entonces SÍ solicita el número de teléfono
-            - Si detectas "PURCHASE_INTENT_DETECTED" en las recomendaciones de ventas pero el estado es "USER_HAS_PHONE_REGISTERED", NO solicites el teléfono
-            - Si detectas "PURCHASE_INTENT_DETECTED_WITH_PHONE" en las recomendaciones de ventas, NO solicites el teléfono
-            - SIEMPRE verifica el estado actual del teléfono antes de decidir si solicitarlo o no
-            
-            Basándote en esta información, proporciona una respuesta completa y útil al usuario.
-            Mantén el tono amigable y comercial de BaekhoBot 🥋.
-            """
-            
-            final_response = await self.llm_response_async(context_prompt)
+            # Generate final response combining information
+            context_prompt = CONTEXT_PROMPT_TMPL.format_map({
+                "message": message,
+                "knowledge": knowledge_response,
+                "sales": sales_response,
+                "phone_status": phone_status_for_context
+            })
+            
+            llm_response = await self._fast_llm.achat(
+                [
+                    LLMMessage(role=Role.SYSTEM, content=self.config.system_message),
+                    LLMMessage(role=Role.USER, content=context_prompt),
+                ],
+                max_tokens=langroid_config.LLM_CONFIG_FAST.max_output_tokens
+            )
+            final_response = llm_response.message
             
-            # Rastrear respuesta con Analytics Agent
+            # Rastrear respuesta con Analytics Agent (Python puro, en el event loop)
             self.analytics_agent.track_conversation(message, final_response)
             
             return final_response
@@ -23,6 +23,16 @@ class LangroidConfig:
         timeout=30,
     )
     
+    # Modelo ligero para la síntesis final de respuestas
+    LLM_CONFIG_FAST = OpenAIGPTConfig(
+        chat_model= os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini"),
+        api_key= os.getenv("OPENAI_API_KEY", ""),
+        chat_context_length=8000,
+        max_output_tokens=1000,
+        temperature=0.3,
+        timeout=30,
+    )
+    
     # ===== CONFIGURACIÓN DE EMBEDDINGS =====
     EMBEDDING_CONFIG = OpenAIEmbeddingsConfig(
         model_type="text-embedding-3-small",
@@ -46,7 +56,8 @@ class LangroidConfig:
         "max_turns": 10,
         "stream": False,
         "debug": settings.DEBUG,
-        "show_stats": True
+        "show_stats": True,
+        "subagent_timeout": 20  # Segundos máximos para el Knowledge Agent
     }
 
     # ===== PROMPTS DEL SISTEMA =====
@@ -84,8 +95,8 @@ class LangroidConfig:
 
         **GESTIÓN DE DISPONIBILIDAD:**
         - SIEMPRE revisa el campo 'disponible' en la información de productos para determinar su estado.
-        - Si 'disponible' es True, el producto ESTÁ DISPONIBLE. NO menciones la disponibilidad en tu respuesta, omite esta información por completo.
-        - Si 'disponible' es False, el producto NO ESTÁ DISPONIBLE. Si el producto no está disponible, menciónalo claramente y agrega que el inventario se reabastecerá pronto.
+        - Si 'disponible' es true, el producto ESTÁ DISPONIBLE. NO menciones la disponibilidad en tu respuesta, omite esta información por completo.
+        - Si 'disponible' es false, el producto NO ESTÁ DISPONIBLE. Si el producto no está disponible, menciónalo claramente y agrega que el inventario se reabastecerá pronto.
         - No asumas que no hay disponibilidad si no ves información clara.
         - Responde con precisión basándote únicamente en este campo booleano.
         - NUNCA incluyas productos no disponibles en tus respuestas a menos que la consulta del usuario coincida de forma inequívoca con uno de ellos.
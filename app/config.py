@@ -36,6 +36,8 @@ class Settings:
     QDRANT_API_KEY: str = os.getenv("QDRANT_API_KEY", "")
     QDRANT_COLLECTION_NAME: str = os.getenv("QDRANT_COLLECTION_NAME", "sportbot_collection")
     
+    # ===== CONFIGURACIÓN DE REDIS (caché compartida entre workers) =====
+    REDIS_URL: str = os.getenv("REDIS_URL", "")
     
     # ===== CONFIGURACIÓN DE OPENAI/LLM =====
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
@@ -1,11 +1,43 @@
 from sentence_transformers import SentenceTransformer
+from concurrent.futures import Future
+from functools import wraps
 from typing import List, Union
+import hashlib
 import logging
+import queue
+import threading
+import time
 import numpy as np
 from app.config import Config
+from app.services import shared_cache
 
 logger = logging.getLogger(__name__)
 
+ENCODE_BATCH_SIZE = 32
+ENCODE_BATCH_WAIT_MS = 5
+SHARED_EMBEDDING_TTL = 24 * 60 * 60
+
+def _shared_embedding_cache(namespace: str):
+    """
+    Reuse query embeddings computed by any worker through the shared cache (FP16).
+    Each method gets its own key namespace because they return different kinds of vectors.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, query: str) -> List[float]:
+            key = f"emb:{namespace}:{hashlib.sha1(query.encode('utf-8')).hexdigest()}"
+            cached = shared_cache.get(key)
+            if cached is not None:
+                return np.frombuffer(cached, dtype=np.float16).astype(np.float32).tolist()
+            
+            embedding = func(self, query)
+            # No cachear el vector cero que se devuelve ante errores
+            if any(embedding):
+                shared_cache.set(key, np.asarray(embedding, dtype=np.float16).tobytes(), SHARED_EMBEDDING_TTL)
+            return embedding
+        return wrapper
+    return decorator
+
 class EmbeddingService:
     def __init__(self):
         """Initialize embedding model"""
@@ -54,6 +86,7 @@ class EmbeddingService:
             else:
                 return [[0.0] * self.dimension] * len(text)
     
+    @_shared_embedding_cache("r")
     def encode_query(self, query: str) -> List[float]:
         """
         Encode a search query into embedding
@@ -66,6 +99,48 @@ class EmbeddingService:
         """
         return self.encode_text(query)
     
+    def encode_queries_batch(self, queries: List[str]) -> np.ndarray:
+        """
+        Encode several queries in a single forward pass
+        
+        Args:
+            queries: List of query strings
+            
+        Returns:
+            L2-normalized float32 matrix with one row per query
+        """
+        embeddings = self.model.encode(
+            queries,
+            batch_size=ENCODE_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        )
+        return embeddings
+    
+    @_shared_embedding_cache("n")
+    def encode_query_batched(self, query: str) -> List[float]:
+        """
+        Encode a query through the shared micro-batcher so concurrent
+        callers share one forward pass
+        
+        Args:
+            query: Search query string
+            
+        Returns:
+            Normalized embedding vector for the query
+        """
+        try:
+            return self._get_batcher().submit(query).result().tolist()
+        except Exception as e:
+            logger.error(f"Error encoding batched query: {str(e)}")
+            return [0.0] * self.dimension
+    
+    def _get_batcher(self) -> "_QueryBatcher":
+        with _batcher_lock:
+            if getattr(self, "_batcher", None) is None:
+                self._batcher = _QueryBatcher(self)
+        return self._batcher
+    
     def encode_documents(self, documents: List[str]) -> List[List[float]]:
         """
         Encode multiple documents into embeddings
@@ -119,4 +194,47 @@ class EmbeddingService:
             'model_name': Config.EMBEDDING_MODEL,
             'dimension': self.dimension,
             'max_seq_length': getattr(self.model, 'max_seq_length', 'Unknown')
-        }
\ No newline at end of file
+        }
+
+
+class _QueryBatcher:
+    """Collects concurrent queries for a few ms and encodes them together"""
+    
+    def __init__(self, service: EmbeddingService,
+                 max_batch: int = ENCODE_BATCH_SIZE, max_wait_ms: float = ENCODE_BATCH_WAIT_MS):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+    
+    def submit(self, query: str) -> Future:
+        future: Future = Future()
+        self._queue.put((query, future))
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # La ventana se cuenta desde el primer elemento, no por elemento
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+            
+            try:
+                embeddings = self.service.encode_queries_batch([query for query, _ in batch])
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+_batcher_lock = threading.Lock()
@@ -1,11 +1,16 @@
 # Si se requiere recuperar contexto desde la base vectorial antes de enviar al LLM
 
+import asyncio
 import os
 import logging
+import queue
+import threading
+import time
 import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from typing import List, Dict, Any, Optional
 
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from qdrant_client import models
 from qdrant_client.models import Filter, FieldCondition, MatchValue, SearchRequest, PointStruct, VectorParams, Distance
 from app.config import *
@@ -17,18 +22,132 @@ QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 QDRANT_COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "sportbot_collection")
 QDRANT_ENABLED = os.getenv("QDRANT_ENABLED", "true").lower() == "true"
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "intfloat/multilingual-e5-small")
 VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 384))
 
+# Candidatos por resultado final que se traen en la etapa de prefetch
+PREFETCH_OVERSAMPLE = int(os.getenv("QDRANT_PREFETCH_OVERSAMPLE", 4))
+PREFETCH_HNSW_EF = int(os.getenv("QDRANT_PREFETCH_HNSW_EF", 64))
+
+# Cuantización escalar int8 de los vectores (con rescoring en búsqueda)
+SCALAR_QUANTIZATION = models.ScalarQuantization(
+    scalar=models.ScalarQuantizationConfig(
+        type=models.ScalarType.INT8,
+        quantile=0.99,
+        always_ram=True
+    )
+)
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QDRANT_QUANTIZATION_OVERSAMPLING", 2.0))
+
+# Micro-batching de búsquedas concurrentes
+SEARCH_BATCH_SIZE = int(os.getenv("QDRANT_SEARCH_BATCH_SIZE", 16))
+SEARCH_BATCH_WAIT_MS = float(os.getenv("QDRANT_SEARCH_BATCH_WAIT_MS", 5))
+
+# Timeout (s) de las llamadas a Qdrant; la espera síncrona de un lote suma la ventana de batching
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 10))
+BATCH_RESULT_TIMEOUT = QDRANT_TIMEOUT + SEARCH_BATCH_WAIT_MS / 1000
+
 _client: Optional[QdrantClient] = None
 
+_client_lock = threading.Lock()
+
+def _get_client() -> QdrantClient:
+    """Return the process-wide Qdrant client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = QdrantClient(
+                    url=QDRANT_URL,
+                    api_key=QDRANT_API_KEY,
+                    prefer_grpc=QDRANT_PREFER_GRPC,
+                    timeout=QDRANT_TIMEOUT
+                )
+    return _client
+
+_async_client: Optional[AsyncQdrantClient] = None
+
+def _get_async_client() -> AsyncQdrantClient:
+    """Return the process-wide async Qdrant client, creating it inside the running loop"""
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncQdrantClient(
+                    url=QDRANT_URL,
+                    api_key=QDRANT_API_KEY,
+                    prefer_grpc=QDRANT_PREFER_GRPC,
+                    timeout=QDRANT_TIMEOUT
+                )
+    return _async_client
+
+class _SearchBatcher:
+    """Groups concurrent query requests into query_batch_points calls"""
+    
+    def __init__(self, client: QdrantClient, collection_name: str,
+                 max_batch: int = SEARCH_BATCH_SIZE, max_wait_ms: float = SEARCH_BATCH_WAIT_MS):
+        self.client = client
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="qdrant-batcher", daemon=True)
+        self._worker.start()
+    
+    def submit(self, request: models.QueryRequest) -> Future:
+        future: Future = Future()
+        self._queue.put((request, future))
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # La ventana se cuenta desde el primer elemento, no por elemento
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+            
+            # Descartar solicitudes cuyo llamador ya canceló (p. ej. por timeout)
+            batch = [(request, future) for request, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            
+            try:
+                responses = self.client.query_batch_points(
+                    collection_name=self.collection_name,
+                    requests=[request for request, _ in batch]
+                )
+                for (_, future), response in zip(batch, responses):
+                    if not future.done():
+                        future.set_result(response.points)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+_batcher: Optional[_SearchBatcher] = None
+_batcher_lock = threading.Lock()
+
+def _get_batcher() -> _SearchBatcher:
+    """Return the process-wide search batcher, starting it on first use"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = _SearchBatcher(_get_client(), QDRANT_COLLECTION_NAME)
+    return _batcher
+
 class QdrantService:
     def __init__(self):
-        self.client = QdrantClient(
-            url=QDRANT_URL,            
-            api_key=QDRANT_API_KEY
-        )
+        self.client = _get_client()
         self.collection_name = QDRANT_COLLECTION_NAME
         self.vector_size = VECTOR_SIZE
 
@@ -44,7 +163,8 @@ class QdrantService:
                     vectors_config=VectorParams(
                         size=self.vector_size,
                         distance=Distance.COSINE
-                    )
+                    ),
+                    quantization_config=SCALAR_QUANTIZATION
                 )
                 logger.info(f"Created collection: {self.collection_name}")
                 
@@ -62,6 +182,7 @@ class QdrantService:
             # Create indexes for fields we want to filter by
             indexes_to_create = [
                 ("tipo", models.PayloadSchemaType.KEYWORD),
+                ("categoria", models.PayloadSchemaType.KEYWORD),
                 ("activa", models.PayloadSchemaType.BOOL),
                 ("disponible", models.PayloadSchemaType.BOOL),
                 ("categoria_id", models.PayloadSchemaType.INTEGER),
@@ -95,7 +216,8 @@ class QdrantService:
                     vectors_config=VectorParams(
                         size=self.vector_size,
                         distance=Distance.COSINE
-                    )
+                    ),
+                    quantization_config=SCALAR_QUANTIZATION
                 )
                 logger.info(f"Created collection: {self.collection_name}")
                 
@@ -170,8 +292,76 @@ class QdrantService:
             logger.error(f"Error upserting documents: {str(e)}")
             return False
     
+    @staticmethod
+    def _build_filter(filters: Optional[Dict[str, Any]]) -> Optional[models.Filter]:
+        """Build a Qdrant filter matching every key/value pair"""
+        if not filters:
+            return None
+        
+        conditions = []
+        for key, value in filters.items():
+            if isinstance(value, list):
+                conditions.append(
+                    models.FieldCondition(
+                        key=key,
+                        match=models.MatchAny(any=value)
+                    )
+                )
+            else:
+                conditions.append(
+                    models.FieldCondition(
+                        key=key,
+                        match=models.MatchValue(value=value)
+                    )
+                )
+        
+        return models.Filter(must=conditions) if conditions else None
+    
+    @staticmethod
+    def _payload_selector(payload_fields: Optional[List[str]]):
+        """Restrict the returned payload to the given fields, if any"""
+        if payload_fields:
+            return models.PayloadSelectorInclude(include=payload_fields)
+        return True
+    
+    @staticmethod
+    def _prefetch(query_vector: List[float], search_filter: Optional[models.Filter],
+                  limit: int) -> List[models.Prefetch]:
+        """Dense candidate stage shared by single and batched searches"""
+        return [
+            models.Prefetch(
+                query=query_vector,
+                filter=search_filter,
+                limit=limit * PREFETCH_OVERSAMPLE,
+                params=models.SearchParams(
+                    hnsw_ef=PREFETCH_HNSW_EF,
+                    quantization=models.QuantizationSearchParams(
+                        rescore=True,
+                        oversampling=QUANTIZATION_OVERSAMPLING
+                    )
+                )
+            )
+        ]
+    
+    @staticmethod
+    def _to_document(point, score: Optional[float]) -> Dict[str, Any]:
+        """Convert a Qdrant point into the document dict returned to callers"""
+        payload = point.payload or {}
+        return {
+            'id': point.id,
+            'score': score,
+            'content': payload.get('content', ''),
+            'payload': payload,  # Incluir payload completo
+            'metadata': payload.get('metadata', {}),
+            'tipo': payload.get('tipo', 'producto'),
+            'categoria_id': payload.get('categoria_id'),
+            'precio': payload.get('precio'),
+            'disponible': payload.get('disponible', True)
+        }
+    
     def search_similar(self, query_vector: List[float], limit: int = 5, 
-                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+                      filters: Optional[Dict[str, Any]] = None,
+                      payload_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """Search for similar documents"""
         try:
             try:
@@ -183,50 +373,19 @@ class QdrantService:
                 logger.error(f"Collection {self.collection_name} not found or inaccessible: {str(e)}")
                 return []
             
-            search_filter = None
-            if filters:
-                conditions = []
-                for key, value in filters.items():
-                    if isinstance(value, list):
-                        conditions.append(
-                            models.FieldCondition(
-                                key=key,
-                                match=models.MatchAny(any=value)
-                            )
-                        )
-                    else:
-                        conditions.append(
-                            models.FieldCondition(
-                                key=key,
-                                match=models.MatchValue(value=value)
-                            )
-                        )
-                
-                if conditions:
-                    search_filter = models.Filter(must=conditions)
+            search_filter = self._build_filter(filters)
             
-            results = self.client.search(
+            results = self.client.query_points(
                 collection_name=self.collection_name,
-                query_vector=query_vector,
-                limit=limit,
+                query=query_vector,
+                prefetch=self._prefetch(query_vector, search_filter, limit),
                 query_filter=search_filter,
-                with_payload=True
-            )
+                limit=limit,
+                with_payload=self._payload_selector(payload_fields),
+                with_vectors=False
+            ).points
             
-            documents = []
-            for result in results:
-                doc = {
-                    'id': result.id,
-                    'score': result.score,
-                    'content': result.payload.get('content', ''),
-                    'payload': result.payload,  # Incluir payload completo
-                    'metadata': result.payload.get('metadata', {}),
-                    'tipo': result.payload.get('tipo', 'producto'),
-                    'categoria_id': result.payload.get('categoria_id'),
-                    'precio': result.payload.get('precio'),
-                    'disponible': result.payload.get('disponible', True)
-                }
-                documents.append(doc)
+            documents = [self._to_document(result, result.score) for result in results]
             
             logger.debug(f"Found {len(documents)} similar documents with scores: {[d['score'] for d in documents]}")
             return documents
@@ -235,6 +394,91 @@ class QdrantService:
             logger.error(f"Error searching documents: {str(e)}")
             return []
 
+    def _query_request(self, query_vector: List[float], limit: int,
+                       filters: Optional[Dict[str, Any]],
+                       payload_fields: Optional[List[str]]) -> models.QueryRequest:
+        """Build the batchable equivalent of search_similar's query"""
+        search_filter = self._build_filter(filters)
+        return models.QueryRequest(
+            query=query_vector,
+            prefetch=self._prefetch(query_vector, search_filter, limit),
+            filter=search_filter,
+            limit=limit,
+            with_payload=self._payload_selector(payload_fields),
+            with_vector=False
+        )
+
+    def batched_search(self, query_vector: List[float], limit: int = 5,
+                       filters: Optional[Dict[str, Any]] = None,
+                       payload_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Search for similar documents through the shared micro-batcher.
+        Concurrent callers are grouped into a single query_batch_points call.
+        """
+        try:
+            request = self._query_request(query_vector, limit, filters, payload_fields)
+            results = _get_batcher().submit(request).result(timeout=BATCH_RESULT_TIMEOUT)
+            return [self._to_document(point, point.score) for point in results]
+            
+        except FutureTimeoutError:
+            logger.error(f"Batched search timed out after {BATCH_RESULT_TIMEOUT}s")
+            return []
+        except Exception as e:
+            logger.error(f"Error in batched search: {str(e)}")
+            return []
+
+    async def batched_search_async(self, query_vector: List[float], limit: int = 5,
+                                   filters: Optional[Dict[str, Any]] = None,
+                                   payload_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Async variant of batched_search; awaits the batch without blocking the event loop"""
+        try:
+            request = self._query_request(query_vector, limit, filters, payload_fields)
+            results = await asyncio.wrap_future(_get_batcher().submit(request))
+            return [self._to_document(point, point.score) for point in results]
+            
+        except Exception as e:
+            logger.error(f"Error in batched search: {str(e)}")
+            return []
+
+    def scroll_by_filter(self, filters: Dict[str, Any], limit: int = 10,
+                         payload_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Retrieve documents matching a payload filter without a vector search"""
+        try:
+            points, _ = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=self._build_filter(filters),
+                limit=limit,
+                with_payload=self._payload_selector(payload_fields),
+                with_vectors=False
+            )
+            
+            documents = [self._to_document(point, None) for point in points]
+            
+            logger.debug(f"Scrolled {len(documents)} documents matching {filters}")
+            return documents
+            
+        except Exception as e:
+            logger.error(f"Error scrolling documents: {str(e)}")
+            return []
+
+    async def scroll_by_filter_async(self, filters: Dict[str, Any], limit: int = 10,
+                                     payload_fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Retrieve documents matching a payload filter without blocking the event loop"""
+        try:
+            points, _ = await _get_async_client().scroll(
+                collection_name=self.collection_name,
+                scroll_filter=self._build_filter(filters),
+                limit=limit,
+                with_payload=self._payload_selector(payload_fields),
+                with_vectors=False
+            )
+            
+            return [self._to_document(point, None) for point in points]
+            
+        except Exception as e:
+            logger.error(f"Error scrolling documents: {str(e)}")
+            return []
+
     def delete_documents(self, document_ids: List[str]) -> bool:
         """Delete documents by IDs"""
         try:
@@ -0,0 +1,66 @@
+# Caché compartida entre workers (Redis); si no está configurada, todas las operaciones son no-op
+
+import logging
+import threading
+import time
+from typing import Optional
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Tras un fallo, no se vuelve a contactar Redis durante este tiempo
+UNAVAILABLE_COOLDOWN_SECONDS = 30
+
+_client: Optional[redis.Redis] = None
+_client_lock = threading.Lock()
+_unavailable_until = 0.0
+
+def _get_client() -> Optional[redis.Redis]:
+    """Return the process-wide Redis client, or None if unconfigured or cooling down after a failure"""
+    global _client
+    if not settings.REDIS_URL or time.monotonic() < _unavailable_until:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    settings.REDIS_URL,
+                    socket_timeout=0.05,
+                    socket_connect_timeout=0.1,
+                    retry=Retry(NoBackoff(), 0)
+                )
+    return _client
+
+def _mark_unavailable(operation: str, key: str, error: Exception):
+    global _unavailable_until
+    _unavailable_until = time.monotonic() + UNAVAILABLE_COOLDOWN_SECONDS
+    logger.warning(
+        f"Shared cache {operation} failed for {key}, disabled for "
+        f"{UNAVAILABLE_COOLDOWN_SECONDS}s: {str(error)}"
+    )
+
+def get(key: str) -> Optional[bytes]:
+    """Get a cached value; any Redis failure is treated as a miss"""
+    client = _get_client()
+    if client is None:
+        return None
+    try:
+        return client.get(key)
+    except redis.RedisError as e:
+        _mark_unavailable("get", key, e)
+        return None
+
+def set(key: str, value: bytes, ttl: int):
+    """Store a value with a TTL in seconds; failures are ignored"""
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        client.set(key, value, ex=ttl)
+    except redis.RedisError as e:
+        _mark_unavailable("set", key, e)